@@ -1,9 +1,11 @@
 # from config import DevelopmentConfig, ProductionConfig
 from dotenv import dotenv_values
-from datetime import datetime, timedelta, timezone
-import requests, logging
-from bs4 import BeautifulSoup
-from pymongo import MongoClient
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta, timezone
+import aiohttp, asyncio, logging, orjson, os
+import lxml.html
+from lxml import etree
+from pymongo import ASCENDING, MongoClient, UpdateOne
 
 config = dotenv_values(".env")
 logging.basicConfig(
@@ -14,194 +16,371 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 LOGGER = logging.getLogger(__name__)
+# bytes read from the response per parser feed
+CHUNK_SIZE = 1 << 16
+# buffer for the html and jsonl files, the streamed page is flushed in
+# a few large writes instead of one per chunk
+WRITE_BUFFER = 1 << 20
+# number of upserts sent to MongoDB per bulk_write
+BATCH_SIZE = 100
+# pooled MongoDB client, see get_client
+CLIENT = None
+
+
+@dataclass(slots=True)
+class Flight:
+    """
+    A single scraped flight
+    """
+
+    gate: str
+    airline: str
+    src_dest: str
+    flight_num: str
+    scheduled_timestamp: datetime
+    actual_timestamp: datetime | None = None
+    type: str = ""
+
+    def to_bson(self):
+        """
+        :return: the flight as a document, without keys whose value is None
+        :rtype: {"flight_num":"WS197", ...}
+        """
+        # one of the advantages of MongoDB is flexibile schema,
+        # so only keys with not null values are stored
+        return {
+            name: value
+            for name in self.__slots__
+            if (value := getattr(self, name)) is not None
+        }
 
 
 def get_client():
     """
-    :return: a connection to the database
+    :return: a connection to the database, shared by every caller in the process
     """
+    global CLIENT
+    if CLIENT is not None:
+        return CLIENT
+
     uri = "mongodb://%s" % (config["DB_HOST"],)
     try:
-        client = MongoClient(uri)
+        CLIENT = MongoClient(
+            uri,
+            maxPoolSize=64,
+            minPoolSize=4,
+            retryWrites=True,
+            # fail fast instead of waiting out the 30s default on every cron run
+            serverSelectionTimeoutMS=5000,
+        )
     except Exception as e:
         LOGGER.error("Error connecting to MongoDB Platform: %s", e)
         exit(1)
-    return client
+    return CLIENT
 
 
-def get_flights(url, table_id):
+async def fetch(session, url, path):
     """
-    Gets the table of flights from the given url
+    Fetches the page at the given url, parsing it as it arrives
+    :param session: the aiohttp session to fetch with
     :param url: the url to scrape
+    :param path: file the raw page is saved to, only replaced once the page parses
+    :return: the parsed page
+    :rtype: lxml.html.HtmlElement
+    """
+    # the page is streamed into a temp file so a failed fetch
+    # never clobbers an earlier good dump of the same day
+    tmp = f"{path}.part"
+    async with session.get(url) as page:
+        page.raise_for_status()
+        # the page may only declare its charset in the Content-Type header,
+        # without it libxml2 would fall back to Latin-1; if the header has
+        # none, leave it to libxml2 so a <meta charset> is still honoured
+        parser = lxml.html.HTMLParser(encoding=page.charset)
+        try:
+            # feed the parser chunk by chunk so parsing overlaps the download
+            # and the whole page is never held in memory as bytes
+            with open(tmp, "wb", buffering=WRITE_BUFFER) as out:
+                async for chunk in page.content.iter_chunked(CHUNK_SIZE):
+                    parser.feed(chunk)
+                    out.write(chunk)
+            root = parser.close()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    os.replace(tmp, path)
+    return root
+
+
+def has_class(name):
+    """
+    :param name: the class to match
+    :return: an XPath predicate matching elements with the given class
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# XPaths over the site's fixed flight table layout, compiled once at import
+# and reused for every row
+ROWS = etree.XPath(
+    f"//table[@id=$id]//tr[{has_class('arrival')} or {has_class('departure')}]"
+)
+# rows missing any of these are skipped
+COMPLETE = etree.XPath(
+    f".//div and .//td[{has_class('ft-gate')}] and .//span and td[3]"
+)
+SCHEDULED = etree.XPath("string(.//div)")
+# only delayed flight have the bubble div
+ACTUAL = etree.XPath(f"string((.//div[{has_class('bubble')}]//div)[2])")
+GATE = etree.XPath(f"string(.//td[{has_class('ft-gate')}])")
+AIRLINE = etree.XPath("string(.//span)")
+FLIGHT_NUM = etree.XPath("string(td[2])")
+SRC_DEST = etree.XPath("string(td[3])")
+
+
+def select_table(root, table_id):
+    """
+    Selects the table of flights from the parsed page
+    :param root: the parsed page
     :param table_id: the id of the table to scrape
-    :return: the table of flights
-    :rtype: bs4.element.ResultSet
+    :return: the rows of the table of flights
+    :rtype: [lxml.html.HtmlElement, ...]
     """
-    page = requests.get(url)
-    soup = BeautifulSoup(page.content, "html.parser")
+    # get the table with id table_id, select rows with class "arrival" or "departure"
+    return ROWS(root, id=table_id)
 
-    # get the table with id "flightsToday", select rows with class "arrival" or "departure"
-    table = soup.find("table", {"id": table_id})
-    if table:
-        table = table.find_all("tr", class_=["arrival", "departure"])
 
-    return table
+def parse_time(value):
+    """
+    Parses a 12-hour clock time as shown on the page, e.g. "7:05 PM"
+    :param value: the time to parse
+    :return: the parsed time
+    :rtype: datetime.time
+    """
+    # the page always uses this one format, so skip strptime's format interpreter
+    clock, meridiem = value.split()
+    hour, minute = clock.split(":")
+    if not 1 <= int(hour) <= 12 or meridiem.upper() not in ("AM", "PM"):
+        raise ValueError(f"time data {value!r} does not match format '%I:%M %p'")
+    hour = int(hour) % 12
+    if meridiem.upper() == "PM":
+        hour += 12
+    return time(hour, int(minute))
+
+
+def parse_row(row, actual_date, scheduled_date):
+    """
+    Parses a single row of the table of flights
+    :param row: the row to parse
+    :param actual_date: the date delayed flights actually depart or arrive on
+    :param scheduled_date: the date the flight was scheduled for
+    :return: the flight, or None if the row is incomplete
+    :rtype: Flight
+    """
+    if not COMPLETE(row):
+        return None
+
+    actual_time = ACTUAL(row).strip()
+    if actual_time:
+        # if the flight is delayed past 11:59pm, due to UTC conversion
+        # the actual_timestamp will be incorrect. gets fixed on next day
+        actual_timestamp = datetime.combine(
+            actual_date, parse_time(actual_time)
+        ).astimezone(timezone.utc)
+    else:
+        actual_timestamp = None
+
+    return Flight(
+        gate=GATE(row).strip(),
+        airline=AIRLINE(row).strip(),
+        src_dest=SRC_DEST(row).strip(),
+        flight_num=FLIGHT_NUM(row).strip(),
+        # timestamps in UTC because that's what MongoDB uses
+        scheduled_timestamp=datetime.combine(
+            scheduled_date, parse_time(SCHEDULED(row).strip())
+        ).astimezone(timezone.utc),
+        actual_timestamp=actual_timestamp,
+        type="departure" if "departure" in row.classes else "arrival",
+    )
 
 
 def parse_flights(table, date=datetime.now(), delayed=False):
     """
     Parses the table of flights
-    :caveat: this function breaks on every Jan 1st for delayed flights
     :param table: the table of flights
     :param date: the date of the flights, format: YYYY-MM-DD; defaults to today
     :param delayed: bool flag for "flightsYesterday"
     :return: list of flights
-    :rtype: [{"flight_num":"WS197",}, {}, ...]
+    :rtype: [Flight, ...]
     """
-    fmt = "%a %b %d"
-    
-    if isinstance(date, datetime):
-        date = date.strftime(fmt)
+    if not isinstance(date, datetime):
+        date = datetime.strptime(date, "%Y-%m-%d")
+
+    # the page only shows times, so every row shares the same base dates;
+    # delayed flights were scheduled yesterday but land today
+    actual_date = date.date()
+    if delayed:
+        scheduled_date = actual_date - timedelta(days=1)
     else:
-        date = datetime.strptime(date, "%Y-%m-%d").strftime(fmt)
+        scheduled_date = actual_date
 
     flights = []
-    
     for row in table:
-        flight = {}
-        try:
-            scheduled_time = row.find("div").text.strip()
-            # only delayed flight have this div
-            actual_time_div = row.find("div", class_="bubble")
-            if actual_time_div:
-                actual_time = actual_time_div.find_all("div")[1].text.strip()
-            else:
-                actual_time = None
-            flight["gate"] = row.find("td", class_="ft-gate").text.strip()
-            flight["airline"] = row.find("span").text.strip()
-            flight["src_dest"] = row.find_all("td")[2].text.strip()
-            flight["flight_num"] = row.find_all("td")[1].text.strip()
-
-        # if AttributeError, skip this flight
-        except AttributeError:
-            continue
-
-        if actual_time:
-            # if the flight is delayed past 11:59pm, due to UTC conversion
-            # the actual_timestamp will be incorrect. gets fixed on next day
-            flight["actual_timestamp"] = (
-                (datetime.strptime(date + " " + actual_time, "%a %b %d %I:%M %p"))
-                .replace(year=datetime.now().year)
-                .astimezone(timezone.utc)
-            )
+        flight = parse_row(row, actual_date, scheduled_date)
+        if flight is not None:
+            flights.append(flight)
 
-        if delayed:
-            date = (datetime.strptime(date, fmt) - timedelta(days=1)).strftime(fmt)
+    return flights
 
-        # timestamps in UTC because that's what MongoDB uses
-        flight["scheduled_timestamp"] = (
-            (datetime.strptime(date + " " + scheduled_time, "%a %b %d %I:%M %p"))
-            .replace(year=datetime.now().year)
-            .astimezone(timezone.utc)
-        )
 
-        # one of the advantages of MongoDB is flexibile schema
-        # i may want to take advantage of that by only storing keys with not null values
-        if "departure" in row["class"]:
-            flight["type"] = "departure"
-        else:
-            flight["type"] = "arrival"
+def upsert_flights(conn, flights):
+    """
+    Upserts the flights into the database
+    :caveat: if a delayed flight is not in the DB, it is inserted from yesterday's table
+    :param conn: connection to the flights collection
+    :param flights: the list of flights to upsert, today's and delayed alike
+    :return: log message
+    """
+    # a flight is keyed by (scheduled_timestamp, flight_num): new flights are
+    # inserted and delayed flights patch the existing document's actual_timestamp
+    ops = [
+        UpdateOne(
+            {
+                "scheduled_timestamp": flight.scheduled_timestamp,
+                "flight_num": flight.flight_num,
+            },
+            {
+                "$set": {k: v for k, v in flight.to_bson().items() if k != "type"},
+                "$setOnInsert": {"type": flight.type},
+            },
+            upsert=True,
+        )
+        for flight in flights
+    ]
+    # errors propagate, main logs them and decides whether the process goes down
+    inserted = updated = 0
+    for i in range(0, len(ops), BATCH_SIZE):
+        result = conn.bulk_write(
+            ops[i : i + BATCH_SIZE], ordered=False, bypass_document_validation=True
+        )
+        inserted += result.upserted_count
+        updated += result.modified_count
+    return (
+        f"Inserted {inserted} and updated {updated} documents in {config['COLLECTION']}"
+    )
 
-        flights.append(flight)
 
-    return flights
+def save_flights(path, flights, date):
+    """
+    Appends a run's parsed flights to a JSON Lines file
+    :param path: the file to append to
+    :param flights: the list of parsed flights
+    :param date: the time of the scrape the flights came from
+    """
+    record = {
+        "date": date.strftime("%Y-%m-%d"),
+        "flights": [flight.to_bson() for flight in flights],
+    }
+    with open(path, "ab", buffering=WRITE_BUFFER) as f:
+        f.write(
+            orjson.dumps(
+                record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NAIVE_UTC
+            )
+        )
 
 
-def add_flights(conn, flights):
+def load_flights(path):
     """
-    Adds the flights to the database
-    :param conn: connection to the flights collection
-    :param flights: the list of flights to add
-    :return: log message
+    Lazily reads back the runs saved by save_flights
+    :param path: the file to read
+    :return: one record per run, timestamps as ISO 8601 strings
+    :rtype: generator of {"date":"2023-10-15", "flights":[{}, ...]}
     """
-    try:
-        results = conn.insert_many(flights)
-        log_msg = f"Inserted {len(results.inserted_ids)} documents into {config['COLLECTION']}"
-    except Exception as e:
-        LOGGER.error("Error inserting documents into MongoDB: %s", e)
-        exit(1)
-    return log_msg
+    with open(path, "rb") as f:
+        for line in f:
+            yield orjson.loads(line)
 
 
-def update_flights(conn, delayed_flights):
+async def scrape(session, flights_collection):
     """
-    Updates the flights collection with the new flights
-    :caveat: if delayed_flights and DB is empty, the wrong flight will be updated
-    :param conn: connection to the flights collection
-    :param delayed_flights: the list of flights to update
+    Scrapes the page once and commits its flights to the database
+    :param session: the aiohttp session to fetch with
+    :param flights_collection: connection to the flights collection
     :return: log message
     """
-    # for flight in delayed_flights, find the corresponding flight
-    # in flights_collection by (scheduled_timestamp, flight_num)
-    # and update it's actual_timestamp
-    updated = 0
-    for flight in delayed_flights:
-        query = {
-            "scheduled_timestamp": flight["scheduled_timestamp"],
-            "flight_num": flight["flight_num"],
-        }
-        update = {"$set": {"actual_timestamp": flight["actual_timestamp"]}}
-        try:
-            result = conn.update_one(query, update)
-            updated += result.modified_count
-        except Exception as e:
-            LOGGER.error("Error updating document in MongoDB: %s", e)
-            exit(1)
-    return f"; Updated {updated} documents"
+    # datetime.now() is passed explicitly, the default is frozen at import
+    # and would go stale in a long running process
+    now = datetime.now()
+
+    # fetch and parse the page once, both tables live on it
+    # the page is saved to html as it streams in
+    root = await fetch(session, config["URL"], f"html/{now.strftime('%Y-%m-%d')}.html")
+    delayed_flights = select_table(root, "flightsYesterday")
+    flight_table = select_table(root, "flightsToday")
+    flights = parse_flights(flight_table, now)
+
+    # save todays parsed flights
+    save_flights("pages/flight_data.jsonl", flights, now)
 
+    if delayed_flights:
+        delayed_flights = parse_flights(delayed_flights, now, delayed=True)
+        # save delayed parsed flights
+        save_flights("pages/delayed_flight_data.jsonl", delayed_flights, now)
+
+    # commit today's and delayed flights to the database in one upsert stream
+    return upsert_flights(flights_collection, flights + (delayed_flights or []))
 
-def main():
+
+async def main():
     # # can i configure the output file of the logger after creating it?
     # if "dev" in sys.argv:
     #     config = DevelopmentConfig()
     # else:
     #     config = ProductionConfig()
 
-    delayed_flights = get_flights(config["URL"], "flightsYesterday")
-    flight_table = get_flights(config["URL"], "flightsToday")
-    flights = parse_flights(flight_table)
-
-    # save page to html
-    with open(f"html/{datetime.now().strftime('%Y-%m-%d')}.html", "w") as f:
-        f.write(requests.get(config["URL"]).text)
-
-    # save todays parsed flights
-    with open("pages/flight_data.py", "a") as f:
-        f.write(f"flights_{datetime.now().strftime('%Y%m%d')} = " + str(flights) + "\n")
+    # with SCRAPE_INTERVAL set the scraper stays up and reuses its
+    # database and http connections across scrapes; otherwise it runs once
+    interval = float(config.get("SCRAPE_INTERVAL") or 0)
 
     # get connection to the database
     client = get_client()
     db = client[config["DB_NAME"]]
     flights_collection = db[config["COLLECTION"]]
+    # flights are upserted by (scheduled_timestamp, flight_num) in upsert_flights;
+    # no-op if the index already exists. this is also the first call to reach
+    # the server, and the build fails if the collection already holds duplicates
+    try:
+        flights_collection.create_index(
+            [("scheduled_timestamp", ASCENDING), ("flight_num", ASCENDING)], unique=True
+        )
+    except Exception as e:
+        LOGGER.error("Error creating index on %s: %s", config["COLLECTION"], e)
+        exit(1)
 
-    # commit the flights to the database
-    log_msg = add_flights(flights_collection, flights)
-
-    if delayed_flights:
-        # commit delayed flights to db
-        delayed_flights = parse_flights(delayed_flights, delayed=True)
-        log_msg += update_flights(flights_collection, delayed_flights)
-        # save delayed parsed flights
-        with open("pages/delayed_flight_data.py", "a") as f:
-            f.write(
-                f"flights_{datetime.now().strftime('%Y%m%d')} = "
-                + str(parse_flights(delayed_flights))
-                + "\n"
-            )
-
-    LOGGER.info(log_msg)
-    client.close()
+    connector = aiohttp.TCPConnector(limit_per_host=64)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                try:
+                    LOGGER.info(await scrape(session, flights_collection))
+                except Exception as e:
+                    # a long running scraper keeps going like the next cron run would
+                    if not interval:
+                        LOGGER.error("Error scraping %s: %s", config["URL"], e)
+                        exit(1)
+                    LOGGER.error(
+                        "Error scraping %s, retrying in %ss: %s",
+                        config["URL"],
+                        interval,
+                        e,
+                    )
+                if not interval:
+                    break
+                await asyncio.sleep(interval)
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())